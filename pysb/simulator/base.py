@@ -801,6 +801,16 @@ class SimulationResult(object):
             self._yexpr_view = [self._yexpr[n].view(float).reshape(len(
                 self._yexpr[n]), -1) for n in range(self.nsims)]
 
+            # Observables are a linear projection of the species, so build
+            # the (species x observables) coefficient matrix once. Only
+            # species which appear in an observable are projected, so NaN
+            # trajectories for other species don't propagate.
+            obs_coeffs = np.zeros((len(self._model.species), len(model_obs)))
+            for i, obs in enumerate(model_obs):
+                np.add.at(obs_coeffs, (obs.species, i), obs.coefficients)
+            obs_species = np.flatnonzero(obs_coeffs.any(axis=1))
+            obs_coeffs = obs_coeffs[obs_species]
+
             # loop over simulations
             sym_names = obs_names + param_names
             expanded_exprs = [sympy.lambdify(sym_names, expr.expand_expr(),
@@ -812,9 +822,9 @@ class SimulationResult(object):
                                           % (n + 1, self.nsims))
 
                 # observables
-                for i, obs in enumerate(model_obs):
-                    self._yobs_view[n][:, i] = (
-                        self._y[n][:, obs.species] * obs.coefficients).sum(axis=1)
+                if obs_names:
+                    self._yobs_view[n][:] = np.dot(
+                        self._y[n][:, obs_species], obs_coeffs)
 
                 # expressions
                 sym_dict = dict((k, self._yobs[n][k]) for k in obs_names)
@@ -1,5 +1,7 @@
 from __future__ import print_function as _
 from pysb.simulator.base import Simulator, SimulatorException, SimulationResult
+from pysb.simulator.scipyode import _compile_rhs_cfunc, \
+    _numba_lsoda_ensemble, _model_rhs_code, numbalsoda
 import pysb
 import pysb.bng
 import numpy as np
@@ -12,9 +14,12 @@ import time
 import logging
 from pysb.logging import EXTENDED_DEBUG
 import shutil
+import pysb.pathfinder
 from pysb.pathfinder import get_path
 import sympy
 import collections
+import functools
+import io
 
 try:
     import pandas as pd
@@ -22,9 +27,181 @@ except ImportError:
     pd = None
 try:
     import pycuda.driver as cuda
+    from pycuda.compiler import SourceModule
 except ImportError:
     cuda = None
 
+_cupsoda_path_error = None
+_device_attributes = {}
+
+# CUDA source for integrating one simulation per GPU thread with an adaptive
+# Cash-Karp Runge-Kutta 4(5) method. max_steps limits the number of steps
+# between consecutive output times, like LSODA's mxstep.
+_PYCUDA_KERNEL_TEMPLATE = """
+#define N_SPECIES %(n_species)d
+#define N_PARAMS %(n_params)d
+
+__device__ void rhs(double t, const double *y, const double *p, double *ydot)
+{
+%(code_eqs)s
+}
+
+extern "C" __global__ void integrate(
+    const double *initials, const double *params, const double *tspan,
+    int n_tspan, int n_sims, double rtol, double atol, int max_steps,
+    double *out, int *status)
+{
+    const int n = blockIdx.x * blockDim.x + threadIdx.x;
+    if (n >= n_sims) return;
+
+    const double *p = params + n * N_PARAMS;
+    double *y_out = out + (size_t)n * n_tspan * N_SPECIES;
+    double y[N_SPECIES], y_new[N_SPECIES], y_err[N_SPECIES],
+           y_tmp[N_SPECIES];
+    double k1[N_SPECIES], k2[N_SPECIES], k3[N_SPECIES], k4[N_SPECIES],
+           k5[N_SPECIES], k6[N_SPECIES];
+    int i, j, steps;
+
+    for (i = 0; i < N_SPECIES; i++) {
+        y[i] = initials[n * N_SPECIES + i];
+        y_out[i] = y[i];
+    }
+
+    double t = tspan[0];
+    double h = 1e-6 * (tspan[n_tspan - 1] - tspan[0]);
+    status[n] = 0;
+
+    for (j = 1; j < n_tspan; j++) {
+        const double t_next = tspan[j];
+        steps = 0;
+        while (t < t_next) {
+            if (steps++ >= max_steps) {
+                status[n] = 1;
+                break;
+            }
+            const double h_step = (t + h > t_next) ? t_next - t : h;
+
+            rhs(t, y, p, k1);
+            for (i = 0; i < N_SPECIES; i++)
+                y_tmp[i] = y[i] + h_step * (1.0 / 5.0) * k1[i];
+            rhs(t + h_step / 5.0, y_tmp, p, k2);
+            for (i = 0; i < N_SPECIES; i++)
+                y_tmp[i] = y[i] + h_step * ((3.0 / 40.0) * k1[i] +
+                                            (9.0 / 40.0) * k2[i]);
+            rhs(t + h_step * 0.3, y_tmp, p, k3);
+            for (i = 0; i < N_SPECIES; i++)
+                y_tmp[i] = y[i] + h_step * (0.3 * k1[i] - 0.9 * k2[i] +
+                                            1.2 * k3[i]);
+            rhs(t + h_step * 0.6, y_tmp, p, k4);
+            for (i = 0; i < N_SPECIES; i++)
+                y_tmp[i] = y[i] + h_step * ((-11.0 / 54.0) * k1[i] +
+                                            2.5 * k2[i] +
+                                            (-70.0 / 27.0) * k3[i] +
+                                            (35.0 / 27.0) * k4[i]);
+            rhs(t + h_step, y_tmp, p, k5);
+            for (i = 0; i < N_SPECIES; i++)
+                y_tmp[i] = y[i] + h_step * ((1631.0 / 55296.0) * k1[i] +
+                                            (175.0 / 512.0) * k2[i] +
+                                            (575.0 / 13824.0) * k3[i] +
+                                            (44275.0 / 110592.0) * k4[i] +
+                                            (253.0 / 4096.0) * k5[i]);
+            rhs(t + h_step * 0.875, y_tmp, p, k6);
+
+            double err = 0.0;
+            for (i = 0; i < N_SPECIES; i++) {
+                y_new[i] = y[i] + h_step * ((37.0 / 378.0) * k1[i] +
+                                            (250.0 / 621.0) * k3[i] +
+                                            (125.0 / 594.0) * k4[i] +
+                                            (512.0 / 1771.0) * k6[i]);
+                y_err[i] = h_step * (
+                    (37.0 / 378.0 - 2825.0 / 27648.0) * k1[i] +
+                    (250.0 / 621.0 - 18575.0 / 48384.0) * k3[i] +
+                    (125.0 / 594.0 - 13525.0 / 55296.0) * k4[i] +
+                    (-277.0 / 14336.0) * k5[i] +
+                    (512.0 / 1771.0 - 0.25) * k6[i]);
+                const double scale = atol + rtol * fmax(fabs(y[i]),
+                                                        fabs(y_new[i]));
+                /* Unlike fmax, propagate NaN errors so the step is
+                   rejected */
+                const double e = fabs(y_err[i]) / scale;
+                if (isnan(e) || e > err) err = e;
+            }
+
+            if (err <= 1.0) {
+                t = (h_step < h) ? t_next : t + h_step;
+                for (i = 0; i < N_SPECIES; i++)
+                    y[i] = y_new[i];
+                const double h_accept = h_step * ((err > 0.0) ?
+                    fmin(5.0, fmax(0.2, 0.9 * pow(err, -0.2))) : 5.0);
+                /* Don't let a step shortened to hit t_next shrink h */
+                h = (h_step < h) ? fmax(h, h_accept) : h_accept;
+            } else {
+                /* Also reached for NaN errors, which shrink the step by the
+                   maximum factor */
+                h = h_step * ((err < 1e10) ?
+                    fmax(0.1, 0.9 * pow(err, -0.25)) : 0.1);
+            }
+        }
+        if (status[n]) {
+            for (; j < n_tspan; j++)
+                for (i = 0; i < N_SPECIES; i++)
+                    y_out[j * N_SPECIES + i] = nan("");
+            return;
+        }
+        for (i = 0; i < N_SPECIES; i++)
+            y_out[j * N_SPECIES + i] = y[i];
+    }
+}
+"""
+
+
+def _get_cupsoda_path():
+    """Return the path to the cupSODA executable.
+
+    A failed lookup is cached, so repeated runs without cupSODA installed
+    don't rescan the search path. The cached failure is ignored once a
+    path has been set with :func:`pysb.pathfinder.set_path`.
+    """
+    global _cupsoda_path_error
+    if _cupsoda_path_error is not None and \
+            'cupsoda' not in pysb.pathfinder._path_cache:
+        raise _cupsoda_path_error
+    try:
+        return get_path('cupsoda')
+    except Exception as e:
+        _cupsoda_path_error = e
+        raise
+
+
+def _get_device_attributes(gpu):
+    """Return the (cached) shared memory and thread limits for a GPU index.
+
+    Returns
+    -------
+    tuple
+        ``(MAX_SHARED_MEMORY_PER_BLOCK, MAX_THREADS_PER_BLOCK)``
+    """
+    try:
+        return _device_attributes[gpu]
+    except KeyError:
+        cuda.init()
+        attrs = cuda.Device(gpu).get_attributes()
+        _device_attributes[gpu] = (
+            attrs[cuda.device_attribute.MAX_SHARED_MEMORY_PER_BLOCK],
+            attrs[cuda.device_attribute.MAX_THREADS_PER_BLOCK])
+        return _device_attributes[gpu]
+
+
+def _savetxt(filename, X, **kwargs):
+    """Like :func:`numpy.savetxt`, but without a newline after the last row.
+
+    cupSODA's input files, other than t_vector, have no trailing newline.
+    """
+    buf = io.BytesIO()
+    np.savetxt(buf, X, **kwargs)
+    with open(filename, 'wb') as f:
+        f.write(buf.getvalue().rstrip(b'\n'))
+
 
 class CupSodaSimulator(Simulator):
     """An interface for running cupSODA, a CUDA implementation of LSODA.
@@ -76,6 +253,12 @@ class CupSodaSimulator(Simulator):
           `default_integrator_options` (default: 'cupsoda')
         * ``integrator_options``: A dictionary of keyword arguments to
           supply to the integrator; see `default_integrator_options`.
+        * ``output_dtype``: NumPy data type of the returned trajectories
+          (default: numpy.float32). Single precision halves the memory and
+          file I/O needed for large ensembles, and input files are then
+          written with single precision too. Use numpy.float64 for very
+          tight tolerances. The numbalsoda CPU fallback (see Notes) returns
+          numpy.float64 unless this is given.
 
     Attributes
     ----------
@@ -130,6 +313,15 @@ class CupSodaSimulator(Simulator):
        observables are output by cupSODA. All other concentrations are set 
        to 'nan'.
 
+    3. If the cupSODA executable cannot be found, simulations are run
+       in-process instead. If PyCUDA is installed they run on the GPU, one
+       simulation per thread, using an adaptive explicit Runge-Kutta (Cash-
+       Karp) method, which may need a large `max_steps` for stiff models.
+       Otherwise, if the `numbalsoda` package is installed, they run on the
+       CPU using one LSODA integration per simulation, distributed across
+       CPU cores. In these modes all species are output, irrespective of
+       `obs_species_only`.
+
     References
     ----------
 
@@ -172,6 +364,13 @@ class CupSodaSimulator(Simulator):
         if not isinstance(self.gpu, collections.Iterable):
             self.gpu = [self.gpu]
         self._obs_species_only = kwargs.pop('obs_species_only', True)
+        output_dtype = kwargs.pop('output_dtype', None)
+        self._output_dtype = np.dtype(
+            np.float32 if output_dtype is None else output_dtype)
+        # The CPU fallback computes in double precision in memory, so only
+        # reduce its precision on request
+        self._cpu_output_dtype = np.dtype(
+            np.float64 if output_dtype is None else output_dtype)
         self._cleanup = kwargs.pop('cleanup', True)
         self._prefix = kwargs.pop('prefix', self._model.name)
         # Sanitize the directory - cupsoda doesn't handle spaces etc. well
@@ -212,13 +411,27 @@ class CupSodaSimulator(Simulator):
 
         # defaults
         self.opts = options
-        self._out_species = None
 
         # private variables (to reduce the number of function calls)
         self._len_rxns = len(self._model.reactions)
         self._len_species = len(self._model.species)
         self._len_params = len(self._model.parameters)
-        self._model_parameters_rules = self._model.parameters_rules()
+
+        # indices of species to output
+        if self._obs_species_only:
+            mask = np.zeros(self._len_species, dtype=bool)
+            for obs in self._model.observables:
+                mask[list(obs.species)] = True
+            self._out_species = np.flatnonzero(mask)
+        else:
+            self._out_species = np.arange(self._len_species, dtype=np.intp)
+
+        # reaction table and stoichiometry matrices (reactions x species)
+        self._build_reaction_soa()
+        self._left_side = self._stoichiometry_matrix(self._rx_reactants_flat,
+                                                     self._rx_reactants_off)
+        self._right_side = self._stoichiometry_matrix(self._rx_products_flat,
+                                                      self._rx_products_off)
 
         # Set cupsoda verbosity level
         logger_level = self._logger.logger.getEffectiveLevel()
@@ -232,45 +445,66 @@ class CupSodaSimulator(Simulator):
         # regex for extracting cupSODA reported running time
         self._running_time_regex = re.compile(r'Running time:\s+(\d+\.\d+)')
 
+        # method for loading cupSODA output files
+        self._load_output = functools.partial(
+            self._load_with_pandas if pd is not None else
+            self._load_with_openfile, dtype=self._output_dtype)
+
+        # single precision output only needs single precision input files
+        self._float_fmt = '%.7g' if self._output_dtype.itemsize <= 4 else \
+            '%.17g'
+
     def _run_chunk(self, gpus, outdir, chunk_idx, cmtx, sims, trajectories,
-                   tout):
+                   tout, bin_path):
         _indirs = {}
         _outdirs = {}
         p = {}
 
-        # Path to cupSODA executable
-        bin_path = get_path('cupsoda')
-
-        # Start simulations
-        for gpu in gpus:
-            _indirs[gpu] = os.path.join(outdir, "INPUT_GPU{}_{}".format(
-                gpu, chunk_idx))
-            os.mkdir(_indirs[gpu])
-            _outdirs[gpu] = os.path.join(outdir, "OUTPUT_GPU{}_{}".format(
-                gpu, chunk_idx))
-
-            # Create cupSODA input files
-            self._create_input_files(_indirs[gpu], sims[gpu], cmtx)
-
-            # Build command
-            # ./cupSODA input_model_folder blocks output_folder simulation_
-            # file_prefix gpu_number fitness_calculation memory_use dump
-            command = [bin_path, _indirs[gpu], str(self.n_blocks),
-                       _outdirs[gpu], self._prefix, str(gpu),
-                       '0', self._memory_usage, str(self._cupsoda_verbose)]
-
-            self._logger.info("Running cupSODA: " + ' '.join(command))
+        # cupSODA's stdout is only used for log messages at INFO level or
+        # below; otherwise discard it rather than pipe it through Python
+        logger_level = self._logger.logger.getEffectiveLevel()
+        # (subprocess.DEVNULL is not available on Python 2)
+        devnull = None if logger_level <= logging.INFO else \
+            open(os.devnull, 'wb')
+        stdout = subprocess.PIPE if devnull is None else devnull
 
-            # Run simulation and return trajectories
-            p[gpu] = subprocess.Popen(command, stdout=subprocess.PIPE,
-                                      stderr=subprocess.PIPE)
+        try:
+            # Start simulations
+            for gpu in gpus:
+                _indirs[gpu] = os.path.join(outdir, "INPUT_GPU{}_{}".format(
+                    gpu, chunk_idx))
+                os.mkdir(_indirs[gpu])
+                _outdirs[gpu] = os.path.join(outdir, "OUTPUT_GPU{}_{}".format(
+                    gpu, chunk_idx))
+
+                # Create cupSODA input files
+                self._create_input_files(_indirs[gpu], sims[gpu], cmtx)
+
+                # Build command
+                # ./cupSODA input_model_folder blocks output_folder simulation_
+                # file_prefix gpu_number fitness_calculation memory_use dump
+                command = [bin_path, _indirs[gpu], str(self.n_blocks),
+                           _outdirs[gpu], self._prefix, str(gpu),
+                           '0', self._memory_usage, str(self._cupsoda_verbose)]
+
+                self._logger.info("Running cupSODA: " + ' '.join(command))
+
+                # Run simulation and return trajectories
+                p[gpu] = subprocess.Popen(command, stdout=stdout,
+                                          stderr=subprocess.PIPE)
+
+            # Wait for simulations to finish
+            outputs = {gpu: p[gpu].communicate() for gpu in gpus}
+        finally:
+            if devnull is not None:
+                devnull.close()
 
         # Read results
         for gpu in gpus:
-            (p_out, p_err) = p[gpu].communicate()
-            p_out = p_out.decode('utf-8')
+            (p_out, p_err) = outputs[gpu]
+            if p_out is not None:
+                p_out = p_out.decode('utf-8')
             p_err = p_err.decode('utf-8')
-            logger_level = self._logger.logger.getEffectiveLevel()
             if logger_level <= logging.INFO:
                 run_time_match = self._running_time_regex.search(p_out)
                 if run_time_match:
@@ -279,29 +513,26 @@ class CupSodaSimulator(Simulator):
                         gpu,
                         chunk_idx,
                         run_time_match.group(1)))
-            self._logger.debug('cupSODA GPU {} chunk {} stdout:\n{}'.format(
-                gpu, chunk_idx, p_out))
+                self._logger.debug('cupSODA GPU {} chunk {} stdout:\n'
+                                   '{}'.format(gpu, chunk_idx, p_out))
             if p_err:
                 self._logger.error('cupSODA GPU {} chunk {} '
                                    'stderr:\n{}'.format(
                     gpu, chunk_idx, p_err))
             if p[gpu].returncode:
+                if p_out is None:
+                    p_out = '(cupSODA stdout was suppressed; re-run with ' \
+                            'verbose=True to include it)'
+                else:
+                    # Drop the source locations cupSODA appends to messages
+                    p_out = re.sub(r'at line.*$', '', p_out, flags=re.M)
                 raise SimulatorException(
                     "cupSODA GPU {} chunk {} exception:\n{}\n{}".format(
-                        gpu, chunk_idx, p_out.rstip("at line"), p_err.rstrip()
+                        gpu, chunk_idx, p_out.rstrip(), p_err.rstrip()
                     )
                 )
-            tout_run, trajectories_run = self._load_trajectories(
-                _outdirs[gpu], sims[gpu])
-            if trajectories is None:
-                tout = tout_run
-                trajectories = trajectories_run
-            else:
-                tout = np.concatenate((tout, tout_run))
-                trajectories = np.concatenate(
-                    (trajectories, trajectories_run))
-
-        return tout, trajectories
+            self._load_trajectories(_outdirs[gpu], sims[gpu], tout,
+                                    trajectories)
 
     def run(self, tspan=None, initials=None, param_values=None):
         """Perform a set of integrations.
@@ -344,6 +575,30 @@ class CupSodaSimulator(Simulator):
 
         start_time = time.time()
 
+        # Path to cupSODA executable
+        try:
+            bin_path = _get_cupsoda_path()
+        except Exception as e:
+            if cuda is not None:
+                self._logger.warning('cupSODA executable not found, running '
+                                     'simulations on GPU using PyCUDA. '
+                                     'Original error: {}'.format(e))
+                tout, trajectories = self._run_pycuda()
+                output_dtype = self._output_dtype
+            elif numbalsoda is not None:
+                self._logger.warning('cupSODA executable not found, running '
+                                     'simulations on CPU using numbalsoda. '
+                                     'Original error: {}'.format(e))
+                tout, trajectories = self._run_cpu_fallback()
+                output_dtype = self._cpu_output_dtype
+            else:
+                raise
+            tout = tout.astype(output_dtype, copy=False)
+            trajectories = trajectories.astype(output_dtype, copy=False)
+            self._logger.info("Fallback simulation time: {} seconds".format(
+                time.time() - start_time))
+            return SimulationResult(self, tout, trajectories)
+
         cmtx = self._get_cmatrix()
 
         outdir = tempfile.mkdtemp(prefix=self._prefix + '_',
@@ -359,8 +614,11 @@ class CupSodaSimulator(Simulator):
 
         chunksize_total = chunksize_gpu * len(self.gpu)
 
-        tout = None
-        trajectories = None
+        # Output arrays for all simulations, filled in place as each chunk
+        # is loaded
+        tout = np.empty((n_sims, len(self.tspan)), dtype=self._output_dtype)
+        trajectories = np.full((n_sims, len(self.tspan), self._len_species),
+                               np.nan, dtype=self._output_dtype)
 
         chunks = np.array_split(range(n_sims),
                                 np.ceil(n_sims / chunksize_total))
@@ -374,9 +632,8 @@ class CupSodaSimulator(Simulator):
                 sims = dict(zip(self.gpu, np.array_split(chunk,
                                                      len(self.gpu))))
 
-                tout, trajectories = self._run_chunk(
-                    self.gpu, outdir, chunk_idx, cmtx, sims,
-                    trajectories, tout)
+                self._run_chunk(self.gpu, outdir, chunk_idx, cmtx, sims,
+                                trajectories, tout, bin_path)
         finally:
             if self._cleanup:
                 shutil.rmtree(outdir)
@@ -386,6 +643,87 @@ class CupSodaSimulator(Simulator):
             end_time - start_time))
         return SimulationResult(self, tout, trajectories)
 
+    def _run_pycuda(self):
+        """Run all simulations on the GPU in-process using PyCUDA.
+
+        Each GPU thread integrates one simulation with an adaptive
+        Cash-Karp Runge-Kutta method, using the first GPU in `gpu`.
+        Returns `tout` and `trajectories` arrays.
+        """
+        n_sims = len(self.param_values)
+        tspan = np.array(self.tspan, dtype=np.float64)
+        source = _PYCUDA_KERNEL_TEMPLATE % {
+            'n_species': self._len_species,
+            'n_params': self._len_params,
+            'code_eqs': _model_rhs_code(self._model, sympy.ccode)
+        }
+        trajectories = np.empty((n_sims, len(tspan), self._len_species))
+        status = np.empty(n_sims, dtype=np.int32)
+        # Spread the simulations over n_blocks, within the limits of the
+        # device and of the compiled kernel (which uses many registers)
+        _, max_threads_per_block = _get_device_attributes(self.gpu[0])
+        threads_per_block = min(-(-n_sims // self.n_blocks),
+                                max_threads_per_block)
+
+        cuda.init()
+        context = cuda.Device(self.gpu[0]).make_context()
+        try:
+            integrate = SourceModule(source, no_extern_c=True).get_function(
+                'integrate')
+            threads_per_block = min(threads_per_block, integrate.get_attribute(
+                cuda.function_attribute.MAX_THREADS_PER_BLOCK))
+            n_blocks = -(-n_sims // threads_per_block)
+            integrate(
+                cuda.In(np.ascontiguousarray(self.initials,
+                                             dtype=np.float64)),
+                cuda.In(np.ascontiguousarray(self.param_values,
+                                             dtype=np.float64)),
+                cuda.In(tspan),
+                np.int32(len(tspan)),
+                np.int32(n_sims),
+                np.float64(self.opts['rtol']),
+                np.float64(self.opts['atol']),
+                np.int32(self.opts['max_steps']),
+                cuda.Out(trajectories),
+                cuda.Out(status),
+                block=(threads_per_block, 1, 1),
+                grid=(n_blocks, 1))
+        finally:
+            context.pop()
+
+        if status.any():
+            self._logger.warning(
+                '{} of {} simulations exceeded max_steps; their remaining '
+                'time points are set to NaN'.format(
+                    np.count_nonzero(status), n_sims))
+        tout = np.tile(tspan, (n_sims, 1))
+        return tout, trajectories
+
+    def _run_cpu_fallback(self):
+        """Run all simulations on the CPU using numbalsoda.
+
+        Returns `tout` and `trajectories` arrays.
+        """
+        rhs = _compile_rhs_cfunc(self._model)
+        tspan = np.array(self.tspan, dtype=float)
+        trajectories, success = _numba_lsoda_ensemble()(
+            rhs.address,
+            np.array(self.initials, dtype=float),
+            tspan,
+            np.array(self.param_values, dtype=float),
+            self.opts['rtol'],
+            self.opts['atol'],
+            self.opts['max_steps'])
+        if not success.all():
+            # Don't return partial integrations, consistent with the
+            # PyCUDA path
+            trajectories[~success] = np.nan
+            self._logger.warning(
+                '{} of {} simulations were not successful'.format(
+                    np.count_nonzero(~success), len(success)))
+        tout = np.tile(tspan, (len(trajectories), 1))
+        return tout, trajectories
+
     @property
     def _memory_usage(self):
         try:
@@ -413,24 +751,16 @@ class CupSodaSimulator(Simulator):
             if cuda is None:
                 threads_per_block = default_threads_per_block
             else:
-                cuda.init()
-                device = cuda.Device(self.gpu[0])
-                attrs = device.get_attributes()
-                shared_memory_per_block = attrs[
-                    cuda.device_attribute.MAX_SHARED_MEMORY_PER_BLOCK]
-                upper_limit_threads_per_block = attrs[
-                    cuda.device_attribute.MAX_THREADS_PER_BLOCK]
-                max_threads_per_block = min(
-                    shared_memory_per_block / memory_per_thread,
-                    upper_limit_threads_per_block)
-                threads_per_block = min(max_threads_per_block,
-                                        default_threads_per_block)
-            n_blocks = int(
-                np.ceil(1. * len(self.param_values) / threads_per_block))
+                shared_memory_per_block, max_threads_per_block = \
+                    _get_device_attributes(self.gpu[0])
+                threads_per_block = max(1, min(
+                    shared_memory_per_block // memory_per_thread,
+                    max_threads_per_block, default_threads_per_block))
+            # Ceiling division, without going through floating point
+            n_blocks = -(-len(self.param_values) // threads_per_block)
             self._logger.debug('n_blocks set to {} (used pycuda: {})'.format(
                 n_blocks, cuda is not None
             ))
-        self.n_blocks = n_blocks
         return n_blocks
 
     @n_blocks.setter
@@ -443,55 +773,21 @@ class CupSodaSimulator(Simulator):
 
     def _create_input_files(self, directory, sims, cmtx):
         # atol_vector
-        with open(os.path.join(directory, "atol_vector"), 'w') as atol_vector:
-            for i in range(self._len_species):
-                atol_vector.write(str(self.opts.get('atol')))
-                if i < self._len_species - 1:
-                    atol_vector.write("\n")
+        _savetxt(os.path.join(directory, "atol_vector"),
+                 np.full(self._len_species, self.opts.get('atol')),
+                 fmt=self._float_fmt)
 
         # c_matrix
-        with open(os.path.join(directory, "c_matrix"), 'w') as c_matrix:
-            for i in sims:
-                line = ""
-                for j in range(self._len_rxns):
-                    if j > 0:
-                        line += "\t"
-                    line += str(cmtx[i][j])
-                c_matrix.write(line)
-                if i != sims[-1]:
-                    c_matrix.write("\n")
+        _savetxt(os.path.join(directory, "c_matrix"), cmtx[sims],
+                 delimiter='\t', fmt=self._float_fmt)
 
         # cs_vector
-        with open(os.path.join(directory, "cs_vector"), 'w') as cs_vector:
-            self._out_species = range(self._len_species)  # species to output
-            if self._obs_species_only:
-                self._out_species = [False for sp in self._model.species]
-                for obs in self._model.observables:
-                    for i in obs.species:
-                        self._out_species[i] = True
-                self._out_species = [i for i in range(self._len_species) if
-                                     self._out_species[i] is True]
-            for i in range(len(self._out_species)):
-                if i > 0:
-                    cs_vector.write("\n")
-                cs_vector.write(str(self._out_species[i]))
+        _savetxt(os.path.join(directory, "cs_vector"), self._out_species,
+                 fmt='%d')
 
         # left_side
-        with open(os.path.join(directory, "left_side"), 'w') as left_side:
-            for i in range(self._len_rxns):
-                line = ""
-                for j in range(self._len_species):
-                    if j > 0:
-                        line += "\t"
-                    stoich = 0
-                    for k in self._model.reactions[i]['reactants']:
-                        if j == k:
-                            stoich += 1
-                    line += str(stoich)
-                if i < self._len_rxns - 1:
-                    left_side.write(line + "\n")
-                else:
-                    left_side.write(line)
+        _savetxt(os.path.join(directory, "left_side"), self._left_side,
+                 delimiter='\t', fmt='%d')
 
         # max_steps
         with open(os.path.join(directory, "max_steps"), 'w') as mxsteps:
@@ -503,97 +799,102 @@ class CupSodaSimulator(Simulator):
             model_kind.write("deterministic")
 
         # MX_0
-        with open(os.path.join(directory, "MX_0"), 'w') as MX_0:
-            mx0 = self.initials
-            # if a volume has been defined, rescale populations
-            # by N_A*vol to get concentration
-            # (NOTE: act on a copy of self.initials, not
-            # the original, which we don't want to modify)
-            if self.vol:
-                mx0 = mx0.copy()
-                mx0 /= (N_A * self.vol)
-            for i in sims:
-                line = ""
-                for j in range(self._len_species):
-                    if j > 0:
-                        line += "\t"
-                    line += str(mx0[i][j])
-                MX_0.write(line)
-                if i != sims[-1]:
-                    MX_0.write("\n")
+        mx0 = self.initials[sims]
+        # if a volume has been defined, rescale populations
+        # by N_A*vol to get concentration
+        if self.vol:
+            mx0 /= (N_A * self.vol)
+        _savetxt(os.path.join(directory, "MX_0"), mx0, delimiter='\t',
+                 fmt=self._float_fmt)
 
         # right_side
-        with open(os.path.join(directory, "right_side"), 'w') as right_side:
-            for i in range(self._len_rxns):
-                line = ""
-                for j in range(self._len_species):
-                    if j > 0:
-                        line += "\t"
-                    stochiometry = 0
-                    for k in self._model.reactions[i]['products']:
-                        if j == k:
-                            stochiometry += 1
-                    line += str(stochiometry)
-                if i < self._len_rxns - 1:
-                    right_side.write(line + "\n")
-                else:
-                    right_side.write(line)
+        _savetxt(os.path.join(directory, "right_side"), self._right_side,
+                 delimiter='\t', fmt='%d')
 
         # rtol
         with open(os.path.join(directory, "rtol"), 'w') as rtol:
             rtol.write(str(self.opts.get('rtol')))
 
-        # t_vector
-        with open(os.path.join(directory, "t_vector"), 'w') as t_vector:
-            for t in self.tspan:
-                t_vector.write(str(float(t)) + "\n")
+        # t_vector and time_max are written at full precision whatever the
+        # output dtype, so that the last output time parses to exactly
+        # time_max
+        tspan = np.asarray(self.tspan, dtype=float)
+        np.savetxt(os.path.join(directory, "t_vector"), tspan, fmt='%.17g')
 
         # time_max
         with open(os.path.join(directory, "time_max"), 'w') as time_max:
-            time_max.write(str(float(self.tspan[-1])))
+            time_max.write(repr(float(tspan[-1])))
+
+    def _build_reaction_soa(self):
+        """Convert the model's reactions into flat arrays.
+
+        Reactants and products are stored as flat arrays of species indices
+        with CSR-style offsets per reaction. Rate constant parameters are
+        stored as a (reactions x max rate parameters) array of parameter
+        indices, padded with the index ``len(model.parameters)``, together
+        with the rate's numeric coefficient per reaction (e.g. the 0.5
+        symmetry factor BNG applies to homodimerization).
+        """
+        reactions = self._model.reactions
+        for field in ('reactants', 'products'):
+            lens = [len(rxn[field]) for rxn in reactions]
+            setattr(self, '_rx_%s_flat' % field, np.fromiter(
+                (sp for rxn in reactions for sp in rxn[field]),
+                dtype=np.int32, count=sum(lens)))
+            setattr(self, '_rx_%s_off' % field, np.concatenate(
+                ([0], np.cumsum(lens))).astype(np.int32))
+        self._rx_order = np.diff(self._rx_reactants_off)
+
+        par_idx = {p.name: i for i, p in enumerate(self._model.parameters)}
+        rate_par_idx = []
+        self._rx_rate_const = np.ones(self._len_rxns)
+        self._rx_has_expressions = False
+        for j, rxn in enumerate(reactions):
+            self._rx_rate_const[j] = float(rxn['rate'].as_coeff_Mul()[0])
+            idx = []
+            for r in rxn['rate'].atoms(sympy.Symbol):
+                if isinstance(r, pysb.Parameter):
+                    idx.append(par_idx[r.name])
+                elif isinstance(r, pysb.Expression):
+                    self._rx_has_expressions = True
+            rate_par_idx.append(idx)
+        max_rate_args = max([len(idx) for idx in rate_par_idx] + [0])
+        self._rx_rate_param_idx = np.full((self._len_rxns, max_rate_args),
+                                          self._len_params, dtype=np.intp)
+        for j, idx in enumerate(rate_par_idx):
+            self._rx_rate_param_idx[j, :len(idx)] = idx
+
+    def _stoichiometry_matrix(self, species_flat, species_off):
+        stoich = np.zeros((self._len_rxns, self._len_species), dtype=int)
+        rxn_idx = np.repeat(np.arange(self._len_rxns), np.diff(species_off))
+        np.add.at(stoich, (rxn_idx, species_flat), 1)
+        return stoich
 
     def _get_cmatrix(self):
-        self._logger.debug("Constructing the c_matrix:")
-        c_matrix = np.zeros((len(self.param_values), self._len_rxns))
-        par_names = [p.name for p in self._model_parameters_rules]
-        rate_mask = np.array([p in self._model_parameters_rules for p in
-                              self._model.parameters])
-        rate_args = []
-        par_vals = self.param_values[:, rate_mask]
-        rate_order = []
-        for rxn in self._model.reactions:
-            rate_args.append([arg for arg in rxn['rate'].atoms(sympy.Symbol) if
-                              not arg.name.startswith('__s')])
-            reactants = len(rxn['reactants'])
-            rate_order.append(reactants)
-        output = 0.01 * len(par_vals)
-        output = int(output) if output > 1 else 1
-        for i in range(len(par_vals)):
-            if i % output == 0:
-                self._logger.debug(str(int(round(100. * i / len(par_vals)))) +
-                                   "%")
-            for j in range(self._len_rxns):
-                rate = 1.0
-                for r in rate_args[j]:
-                    if isinstance(r, pysb.Parameter):
-                        rate *= par_vals[i][par_names.index(r.name)]
-                    elif isinstance(r, pysb.Expression):
-                        raise ValueError('cupSODA does not currently support '
-                                         'models with Expressions')
-                    else:
-                        rate *= r
-                # volume correction
-                if self.vol:
-                    rate *= (N_A * self.vol) ** (rate_order[j] - 1)
-                c_matrix[i][j] = rate
-        self._logger.debug("100%")
+        if self._rx_has_expressions:
+            raise ValueError('cupSODA does not currently support models '
+                             'with Expressions')
+        self._logger.debug("Constructing the c_matrix")
+        # Append a column of ones, which the padded rate parameter indices
+        # point to
+        par_vals = np.hstack((self.param_values,
+                              np.ones((len(self.param_values), 1))))
+        c_matrix = par_vals[:, self._rx_rate_param_idx].prod(axis=2)
+        c_matrix *= self._rx_rate_const
+        # volume correction
+        if self.vol:
+            c_matrix *= (N_A * self.vol) ** (self._rx_order - 1)
         return c_matrix
 
-    def _load_trajectories(self, directory, sims):
+    def _load_trajectories(self, directory, sims, tout, trajectories):
         """Read simulation results from output files.
 
-        Returns `tout` and `trajectories` arrays.
+        Results are written in place into the rows of the `tout` and
+        `trajectories` arrays given by `sims`. Species not output by
+        cupSODA are left untouched (NaN).
         """
+        if len(sims) == 0:
+            return
         files = [filename for filename in os.listdir(directory) if
                  re.match(self._prefix, filename)]
         if len(files) == 0:
@@ -604,78 +905,28 @@ class CupSodaSimulator(Simulator):
                 "Number of output files (%d) does not match number "
                 "of requested simulations (%d)." % (
                 len(files), len(sims)))
-        n_sims = len(files)
-        trajectories = [None] * n_sims
-        tout = [None] * n_sims
-        traj_n = np.ones((len(self.tspan), self._len_species)) * float('nan')
-        tout_n = np.ones(len(self.tspan)) * float('nan')
         # load the data
         indir_prefix = os.path.join(directory, self._prefix)
         for idx, n in enumerate(sims):
-            trajectories[idx] = traj_n.copy()
-            tout[idx] = tout_n.copy()
             filename = indir_prefix + "_" + str(idx)
             if not os.path.isfile(filename):
                 raise Exception("Cannot find input file " + filename)
-            # determine optimal loading method
-            if idx == 0:
-                (data, use_pandas) = self._test_pandas(filename)
-            # load data
-            else:
-                if use_pandas:
-                    data = self._load_with_pandas(filename)
-                else:
-                    data = self._load_with_openfile(filename)
+            data = self._load_output(filename)
             # store data
-            tout[idx] = data[:, 0]
-            trajectories[idx][:, self._out_species] = data[:, 1:]
+            tout[n] = data[:, 0]
+            trajectories[n][:, self._out_species] = data[:, 1:]
             # volume correction
             if self.vol:
-                trajectories[idx][:, self._out_species] *= (N_A * self.vol)
-        return np.array(tout), np.array(trajectories)
-
-    def _test_pandas(self, filename):
-        """ calculates the fastest method to load in data
-
-        Parameters
-        ----------
-        filename : str
-            filename to laod in
-
-        Returns
-        -------
-        np.array, bool
-
-        """
-        # using open(filename,...)
-        start = time.time()
-        data = self._load_with_openfile(filename)
-        end = time.time()
-        load_time_openfile = end - start
-
-        # using pandas
-        if pd:
-            start = time.time()
-            self._load_with_pandas(filename)
-            end = time.time()
-            load_time_pandas = end - start
-            if load_time_pandas < load_time_openfile:
-                return data, True
-
-        return data, False
+                trajectories[n][:, self._out_species] *= N_A * self.vol
 
     @staticmethod
-    def _load_with_pandas(filename):
-        data = pd.read_csv(filename, sep='\t', skiprows=None,
-                           header=None).as_matrix()
-        return data
+    def _load_with_pandas(filename, dtype=np.float64):
+        return pd.read_csv(filename, sep='\t', header=None, engine='c',
+                           dtype=dtype).values
 
     @staticmethod
-    def _load_with_openfile(filename):
-        with open(filename, 'r') as f:
-            data = [line.rstrip('\n').split() for line in f]
-        data = np.array(data, dtype=np.float, copy=False)
-        return data
+    def _load_with_openfile(filename, dtype=np.float64):
+        return np.loadtxt(filename, dtype=dtype, ndmin=2)
 
 
 def run_cupsoda(model, tspan, initials=None, param_values=None,
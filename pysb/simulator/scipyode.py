@@ -16,6 +16,14 @@ try:
     import Cython
 except ImportError:
     Cython = None
+try:
+    import numba
+except ImportError:
+    numba = None
+try:
+    import numbalsoda
+except ImportError:
+    numbalsoda = None
 from sympy.printing.lambdarepr import lambdarepr
 import distutils
 import pysb.bng
@@ -27,6 +35,7 @@ import os
 from pysb.logging import get_logger, EXTENDED_DEBUG
 import logging
 import itertools
+import math
 import contextlib
 import importlib
 from concurrent.futures import ProcessPoolExecutor, Executor, Future
@@ -37,6 +46,7 @@ class ScipyOdeSimulator(Simulator):
     Simulate a model using SciPy ODE integration
 
     Uses :func:`scipy.integrate.odeint` for the ``lsoda`` integrator,
+    :func:`scipy.integrate.solve_ivp` for the ``solve_ivp`` integrator and
     :func:`scipy.integrate.ode` for all other integrators.
 
     .. warning::
@@ -72,16 +82,24 @@ class ScipyOdeSimulator(Simulator):
         Extra keyword arguments, including:
 
         * ``integrator``: Choice of integrator, including ``vode`` (default),
-          ``zvode``, ``lsoda``, ``dopri5`` and ``dop853``. See
-          :func:`scipy.integrate.ode` for further information.
+          ``zvode``, ``lsoda``, ``dopri5``, ``dop853`` and ``solve_ivp``.
+          See :func:`scipy.integrate.ode` for further information.
+          ``solve_ivp`` uses :func:`scipy.integrate.solve_ivp`, with its
+          ``method`` (default: ``LSODA``) set in ``integrator_options``.
         * ``integrator_options``: A dictionary of keyword arguments to
           supply to the integrator. See :func:`scipy.integrate.ode`.
         * ``compiler``: Choice of compiler for ODE system: ``cython``,
-          ``weave`` (Python 2 only), ``theano`` or ``python``. Leave
-          unspecified or equal to None for auto-select (tries weave,
-          then cython, then python). Cython, weave and theano all compile the
-          equation system into C code. Python is the slowest but most
-          compatible.
+          ``weave`` (Python 2 only), ``numba``, ``theano`` or ``python``.
+          Leave unspecified or equal to None for auto-select (tries weave,
+          then cython, then python; numba is only used when requested
+          explicitly). Cython, weave and theano all compile the equation
+          system into C code. Numba compiles it just-in-time to native code
+          with LLVM, the first time the simulator is constructed. When
+          ``numba`` is combined with the ``lsoda`` integrator and the
+          ``numbalsoda`` package is installed, the whole integration runs in
+          native code without calling back into Python, and multiple
+          simulations are run in parallel across CPU threads. Python is the
+          slowest but most compatible.
         * ``cleanup``: Boolean, `cleanup` argument used for
           :func:`pysb.bng.generate_equations` call
 
@@ -130,6 +148,9 @@ class ScipyOdeSimulator(Simulator):
         },
         'lsoda': {
             'mxstep': 2**31-1,
+        },
+        'solve_ivp': {
+            'method': 'LSODA',
         }
     }
 
@@ -185,16 +206,15 @@ class ScipyOdeSimulator(Simulator):
 
         self._compiler_directives = None
 
-        # Use lambdarepr (Python code) with Cython, otherwise use C code
-        eqn_repr = lambdarepr if self._compiler == 'cython' else sympy.ccode
+        # Use lambdarepr (Python code) with Cython and Numba, otherwise use
+        # C code
+        eqn_repr = lambdarepr if self._compiler in ('cython', 'numba') \
+            else sympy.ccode
 
-        if self._compiler in ('weave', 'cython'):
+        if self._compiler in ('weave', 'cython', 'numba'):
             # Prepare the string representations of the RHS equations
 
-            code_eqs = '\n'.join(['ydot[%d] = %s;' %
-                                  (i, eqn_repr(o))
-                                  for i, o in enumerate(ode_mat)])
-            code_eqs = str(self._eqn_substitutions(code_eqs))
+            code_eqs = _model_rhs_code(self._model, eqn_repr, ode_mat)
 
             # Allocate ydot here, once.
             ydot = np.zeros(len(self.model.species))
@@ -215,6 +235,14 @@ class ScipyOdeSimulator(Simulator):
 
                 with _set_cflags_no_warnings(self._logger):
                     rhs(0.0, self.initials[0], self.param_values[0])
+            elif self._compiler == 'numba':
+                if not numba:
+                    raise ImportError('Numba library is not installed')
+
+                rhs = _get_rhs(self._compiler, code_eqs, ydot=ydot)
+
+                # Call rhs once just to trigger the JIT compilation step
+                rhs(0.0, self.initials[0], self.param_values[0])
             else:
                 # Weave
                 self._compiler_directives = []
@@ -302,7 +330,7 @@ class ScipyOdeSimulator(Simulator):
                                     len(self.model.species))
                     return jacmat
 
-            elif self._compiler in ('weave', 'cython'):
+            elif self._compiler in ('weave', 'cython', 'numba'):
                 # Prepare the stringified Jacobian equations.
                 jac_eqs_list = []
                 for i in range(jac_matrix.shape[0]):
@@ -340,6 +368,9 @@ class ScipyOdeSimulator(Simulator):
                     # Manage distutils logging, as above for rhs.
                     with self._patch_distutils_logging:
                         jac_fn(0.0, self.initials[0], self.param_values[0])
+                elif self._compiler == 'numba':
+                    jac_fn = _get_rhs(self._compiler, jac_eqs, jac=jac)
+                    jac_fn(0.0, self.initials[0], self.param_values[0])
                 else:
                     jac_fn = _get_rhs(
                         self._compiler,
@@ -369,7 +400,7 @@ class ScipyOdeSimulator(Simulator):
         # defaults
         self.opts = options
 
-        if integrator != 'lsoda':
+        if integrator not in ('lsoda', 'solve_ivp'):
             # Only used to check the user has selected a valid integrator
             self.integrator = scipy.integrate.ode(rhs, jac=jac_fn)
             with warnings.catch_warnings():
@@ -470,15 +501,7 @@ class ScipyOdeSimulator(Simulator):
         """String substitutions on the sympy C code for the ODE RHS and
         Jacobian functions to use appropriate terms for variables and
         parameters."""
-        # Substitute 'y[i]' for 'si'
-        eqns = re.sub(r'\b__s(\d+)\b',
-                      lambda m: 'y[%s]' % (int(m.group(1))),
-                      eqns)
-
-        # Substitute 'p[i]' for any named parameters
-        for i, p in enumerate(self._model.parameters):
-            eqns = re.sub(r'\b(%s)\b' % p.name, 'p[%d]' % i, eqns)
-        return eqns
+        return _eqn_substitutions(self._model, eqns)
 
     def run(self, tspan=None, initials=None, param_values=None,
             num_processors=1):
@@ -500,7 +523,9 @@ class ScipyOdeSimulator(Simulator):
             Number of processes to use (default: 1). Set to a larger number
             (e.g. the number of CPU cores available) for parallel execution of
             simulations. This is only useful when simulating with more than one
-            set of initial conditions and/or parameters.
+            set of initial conditions and/or parameters. Ignored when
+            simulating natively with numbalsoda (see the ``compiler``
+            option), which always runs simulations in parallel threads.
 
         Returns
         -------
@@ -514,6 +539,31 @@ class ScipyOdeSimulator(Simulator):
 
         num_species = len(self._model.species)
         num_odes = len(self._model.odes)
+        integrator = self._init_kwargs.get('integrator', 'vode')
+        tout = np.array([self.tspan] * n_sims)
+
+        if _use_numbalsoda(self._compiler, integrator, self._jac_eqs,
+                           self.opts):
+            self._logger.debug('Native ensemble mode using numbalsoda')
+            rhs_cfunc = _numba_lsoda_cfunc(self._code_eqs, num_species,
+                                           len(self._model.parameters))
+            lsoda_opts = _numbalsoda_opts(self.opts)
+            trajectories, success = _numba_lsoda_ensemble()(
+                rhs_cfunc.address,
+                np.array(self.initials, dtype=float),
+                np.array(self.tspan, dtype=float),
+                np.array(self.param_values, dtype=float),
+                lsoda_opts['rtol'],
+                lsoda_opts['atol'],
+                lsoda_opts['mxstep']
+            )
+            if not success.all():
+                self._logger.warning(
+                    '{} of {} simulations were not successful'.format(
+                        np.count_nonzero(~success), n_sims))
+            self._logger.info('All simulation(s) complete')
+            return SimulationResult(self, tout, trajectories)
+
         results = []
         if num_processors == 1:
             self._logger.debug('Single processor (serial) mode')
@@ -532,14 +582,13 @@ class ScipyOdeSimulator(Simulator):
                     self.initials[n],
                     self.tspan,
                     self.param_values[n],
-                    self._init_kwargs.get('integrator', 'vode'),
+                    integrator,
                     compiler=self._compiler,
                     integrator_opts=self.opts,
                     compiler_directives=self._compiler_directives
                 ))
             trajectories = [r.result() for r in results]
 
-        tout = np.array([self.tspan] * n_sims)
         self._logger.info('All simulation(s) complete')
         return SimulationResult(self, tout, trajectories)
 
@@ -628,6 +677,14 @@ def _get_rhs(compiler, code_eqs, ydot=None, jac=None, compiler_directives=None):
                                     't', 'y', 'p'],
                          extra_compile_args=compiler_directives)
             return ydot if ydot is not None else jac
+    elif compiler == 'numba':
+        out = ydot if ydot is not None else jac
+        kernel = _numba_kernel(code_eqs, 'ydot' if ydot is not None else 'jac')
+
+        def rhs(t, y, p):
+            # note that the compiled kernel sets out as a side effect
+            kernel(t, y, p, out)
+            return out
     else:
         def rhs(t, y, p):
             return code_eqs(*itertools.chain(y, p))
@@ -635,6 +692,141 @@ def _get_rhs(compiler, code_eqs, ydot=None, jac=None, compiler_directives=None):
     return rhs
 
 
+def _eqn_substitutions(model, eqns):
+    """String substitutions on the sympy code for a model's ODE RHS and
+    Jacobian functions to use appropriate terms for variables and
+    parameters."""
+    # Substitute 'y[i]' for 'si' and 'p[i]' for any named parameters, in a
+    # single pass over the equation text
+    param_idx = {p.name: i for i, p in enumerate(model.parameters)}
+    pattern = r'\b(?:__s(?P<species>\d+)'
+    if param_idx:
+        pattern += '|(?P<param>%s)' % '|'.join(
+            re.escape(name) for name in param_idx)
+    pattern += r')\b'
+
+    def _repl(m):
+        if m.group('species') is not None:
+            return 'y[%d]' % int(m.group('species'))
+        return 'p[%d]' % param_idx[m.group('param')]
+
+    eqns = re.sub(pattern, _repl, eqns)
+    return eqns
+
+
+_numba_cache = {}
+
+
+def _numba_kernel(code_eqs, out_name):
+    """ Compile RHS or Jacobian equation code into a Numba kernel
+
+    The kernel has signature ``kernel(t, y, p, out)`` and writes its result
+    into ``out``. Kernels are cached by their source code, so that repeated
+    simulator construction (and worker processes) only compile once.
+    """
+    key = ('kernel', code_eqs, out_name)
+    try:
+        return _numba_cache[key]
+    except KeyError:
+        pass
+    source = 'def kernel(t, y, p, %s):\n    %s\n' % (
+        out_name, code_eqs.replace('\n', '\n    ') if code_eqs else 'pass')
+    namespace = dict(vars(math), math=math)
+    exec(source, namespace)
+    kernel = numba.njit(namespace['kernel'])
+    _numba_cache[key] = kernel
+    return kernel
+
+
+def _numba_lsoda_cfunc(code_eqs, num_species, num_params):
+    """ Compile RHS equation code into a C callback for numbalsoda """
+    key = ('lsoda', code_eqs, num_species, num_params)
+    try:
+        return _numba_cache[key]
+    except KeyError:
+        pass
+    kernel = _numba_kernel(code_eqs, 'ydot')
+
+    @numba.cfunc(numbalsoda.lsoda_sig)
+    def rhs(t, y, ydot, p):
+        kernel(t, numba.carray(y, num_species), numba.carray(p, num_params),
+               numba.carray(ydot, num_species))
+
+    _numba_cache[key] = rhs
+    return rhs
+
+
+def _model_rhs_code(model, printer=lambdarepr, ode_mat=None):
+    """ Code for a model's ODE RHS, as one ``ydot[i] = ...;`` line per species
+
+    Species and parameters are referred to as ``y[i]`` and ``p[i]``, with
+    parameters in the order of model.parameters. Equations must already
+    have been generated for the model. ``ode_mat`` may be given to reuse
+    ODEs with expressions already expanded.
+    """
+    if ode_mat is None:
+        eqn_subs = {e: e.expand_expr(expand_observables=True) for
+                    e in model.expressions}
+        ode_mat = sympy.Matrix(model.odes).subs(eqn_subs)
+    code_eqs = '\n'.join(['ydot[%d] = %s;' % (i, printer(o))
+                          for i, o in enumerate(ode_mat)])
+    return str(_eqn_substitutions(model, code_eqs))
+
+
+def _compile_rhs_cfunc(model):
+    """ Compile a model's ODE RHS into a numbalsoda C callback
+
+    The callback's parameter vector follows the order of model.parameters.
+    Equations must already have been generated for the model.
+    """
+    return _numba_lsoda_cfunc(_model_rhs_code(model), len(model.species),
+                              len(model.parameters))
+
+
+def _use_numbalsoda(compiler, integrator_name, jac_eqs, integrator_opts):
+    """ Whether an integration can run natively using numbalsoda """
+    return compiler == 'numba' and integrator_name == 'lsoda' and \
+        numbalsoda is not None and not jac_eqs and \
+        set(integrator_opts).issubset(('rtol', 'atol', 'mxstep'))
+
+
+def _numbalsoda_opts(integrator_opts):
+    """ numbalsoda options, defaulting to scipy.integrate.odeint's """
+    lsoda_opts = {'rtol': 1.49012e-8, 'atol': 1.49012e-8, 'mxstep': 500}
+    lsoda_opts.update(integrator_opts)
+    return lsoda_opts
+
+
+def _numba_lsoda_ensemble():
+    """ Numba kernel running one numbalsoda integration per row, in parallel
+
+    Each simulation has its own adaptive step schedule, so simulations are
+    distributed across cores with ``prange``. The kernel has signature
+    ``kernel(funcptr, initials, tspan, param_values, rtol, atol, mxstep)``
+    and returns ``(trajectories, success)``.
+    """
+    key = ('lsoda_ensemble', )
+    try:
+        return _numba_cache[key]
+    except KeyError:
+        pass
+    lsoda = numbalsoda.lsoda
+
+    @numba.njit(parallel=True)
+    def kernel(funcptr, initials, tspan, param_values, rtol, atol, mxstep):
+        n_sims = initials.shape[0]
+        trajectories = np.empty((n_sims, tspan.shape[0], initials.shape[1]))
+        success = np.empty(n_sims, dtype=np.bool_)
+        for n in numba.prange(n_sims):
+            trajectories[n], success[n] = lsoda(
+                funcptr, initials[n], tspan, param_values[n], rtol, atol,
+                mxstep)
+        return trajectories, success
+
+    _numba_cache[key] = kernel
+    return kernel
+
+
 def _integrator_process(code_eqs, jac_eqs, num_species, num_odes, initials,
                         tspan, param_values, integrator_name, compiler,
                         integrator_opts, compiler_directives):
@@ -660,6 +852,23 @@ def _integrator_process(code_eqs, jac_eqs, num_species, num_odes, initials,
             **integrator_opts
         )
 
+    # solve_ivp, which drives the output time loop itself
+    if integrator_name == 'solve_ivp':
+        # Some solve_ivp methods keep references to previous RHS/Jacobian
+        # evaluations, so copy out of the reused ydot/jac buffers
+        sol = scipy.integrate.solve_ivp(
+            lambda t, y: np.array(rhs(t, y, param_values)),
+            (tspan[0], tspan[-1]),
+            initials,
+            t_eval=tspan,
+            jac=(lambda t, y: np.array(jac_fn(t, y, param_values)))
+            if jac_fn else None,
+            **integrator_opts
+        )
+        trajectory = np.full((len(tspan), num_species), np.nan)
+        trajectory[:sol.y.shape[1]] = sol.y.T
+        return trajectory
+
     # All other integrators
     integrator = scipy.integrate.ode(rhs, jac=jac_fn)
     with warnings.catch_warnings():
@@ -672,7 +881,7 @@ def _integrator_process(code_eqs, jac_eqs, num_species, num_odes, initials,
     if jac_eqs:
         integrator.set_jac_params(param_values)
 
-    trajectory = np.ndarray((len(tspan), num_species))
+    trajectory = np.empty((len(tspan), num_species))
     trajectory[0] = initials
     i = 1
     while integrator.successful() and integrator.t < tspan[-1]:
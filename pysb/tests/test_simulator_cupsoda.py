@@ -1,10 +1,20 @@
 import warnings
 import numpy as np
+from pysb.testing import *
+from pysb import Monomer, Parameter, Initial, Rule, Observable
+from pysb.core import as_complex_pattern
 from nose.plugins.attrib import attr
-from pysb.examples.tyson_oscillator import model
-from pysb.simulator.cupsoda import CupSodaSimulator, run_cupsoda
+from pysb.examples.tyson_oscillator import model as tyson_model
+from pysb.simulator.cupsoda import CupSodaSimulator, run_cupsoda, cuda, pd
+from pysb.simulator import ScipyOdeSimulator
+from pysb.simulator.scipyode import numbalsoda
 from nose.tools import raises
+from nose.plugins.skip import SkipTest
 import os
+import functools
+import shutil
+import tempfile
+from scipy.constants import N_A
 
 
 @attr('gpu')
@@ -12,15 +22,16 @@ class TestCupSODASimulatorSingle(object):
     def setUp(self):
         self.n_sims = 50
         self.tspan = np.linspace(0, 500, 101)
-        self.solver = CupSodaSimulator(model, tspan=self.tspan, verbose=False,
+        self.solver = CupSodaSimulator(tyson_model, tspan=self.tspan,
+                                       verbose=False,
                                        integrator_options={'atol': 1e-12,
                                                            'rtol': 1e-12,
                                                            'max_steps': 20000})
-        len_model_species = len(model.species)
+        len_model_species = len(tyson_model.species)
         y0 = np.zeros((self.n_sims, len_model_species))
-        for ic in model.initials:
+        for ic in tyson_model.initials:
             for j in range(len_model_species):
-                if str(ic.pattern) == str(model.species[j]):
+                if str(ic.pattern) == str(tyson_model.species[j]):
                     y0[:, j] = ic.value.value
                     break
         self.y0 = y0
@@ -59,7 +70,7 @@ class TestCupSODASimulatorSingle(object):
         self.solver.run(initials=self.y0)
 
     def test_multi_chunks(self):
-        sim = CupSodaSimulator(model, tspan=self.tspan, verbose=False,
+        sim = CupSodaSimulator(tyson_model, tspan=self.tspan, verbose=False,
                                initials=self.y0,
                                integrator_options={'atol': 1e-12,
                                                    'rtol': 1e-12,
@@ -78,10 +89,10 @@ class TestCupSODASimulatorSingle(object):
 
     def test_run_tyson(self):
         # Rate constants
-        len_parameters = len(model.parameters)
+        len_parameters = len(tyson_model.parameters)
         param_values = np.ones((self.n_sims, len_parameters))
         for j in range(len_parameters):
-            param_values[:, j] *= model.parameters[j].value
+            param_values[:, j] *= tyson_model.parameters[j].value
         simres = self.solver.run(initials=self.y0)
         print(simres.observables)
         self.solver.run(param_values=None, initials=self.y0)
@@ -89,7 +100,7 @@ class TestCupSODASimulatorSingle(object):
         self.solver.run(param_values=param_values, initials=self.y0)
 
     def test_verbose(self):
-        solver = CupSodaSimulator(model, tspan=self.tspan, verbose=True,
+        solver = CupSodaSimulator(tyson_model, tspan=self.tspan, verbose=True,
                                   integrator_options={'atol': 1e-12,
                                                       'rtol': 1e-12,
                                                       'vol': 1e-5,
@@ -97,13 +108,205 @@ class TestCupSODASimulatorSingle(object):
         solver.run()
 
     def test_run_cupsoda_instance(self):
-        run_cupsoda(model, tspan=self.tspan)
+        run_cupsoda(tyson_model, tspan=self.tspan)
 
     @raises(ValueError)
     def test_invalid_init_kwarg(self):
-        CupSodaSimulator(model, tspan=self.tspan, spam='eggs')
+        CupSodaSimulator(tyson_model, tspan=self.tspan, spam='eggs')
 
     @raises(ValueError)
     def test_invalid_integrator_option(self):
-        CupSodaSimulator(model, tspan=self.tspan,
+        CupSodaSimulator(tyson_model, tspan=self.tspan,
                          integrator_options={'spam': 'eggs'})
+
+
+@attr('gpu')
+def test_pycuda():
+    if cuda is None:
+        raise SkipTest('pycuda not installed')
+    n_sims = 2000
+    tspan = np.linspace(0, 500, 101)
+    param_values = np.tile([p.value for p in tyson_model.parameters],
+                           (n_sims, 1))
+    solver = CupSodaSimulator(tyson_model, tspan=tspan,
+                              param_values=param_values,
+                              integrator_options={'atol': 1e-10,
+                                                  'rtol': 1e-10})
+    # More simulations per block than the device allows threads per block
+    solver.n_blocks = 1
+    tout, trajectories = solver._run_pycuda()
+    assert np.allclose(tout[0], tspan)
+    res = ScipyOdeSimulator(tyson_model, tspan=tspan, integrator='lsoda',
+                            integrator_options={'atol': 1e-12,
+                                                'rtol': 1e-12}).run()
+    assert np.allclose(trajectories[0], res.species, rtol=1e-4)
+    assert np.allclose(trajectories[-1], res.species, rtol=1e-4)
+
+
+def test_cpu_fallback():
+    if numbalsoda is None:
+        raise SkipTest('numbalsoda not installed')
+    tspan = np.linspace(0, 500, 101)
+    solver = CupSodaSimulator(tyson_model, tspan=tspan,
+                              integrator_options={'atol': 1e-12,
+                                                  'rtol': 1e-12})
+    tout, trajectories = solver._run_cpu_fallback()
+    assert np.allclose(tout[0], tspan)
+    res = ScipyOdeSimulator(tyson_model, tspan=tspan, integrator='lsoda',
+                            integrator_options={'atol': 1e-12,
+                                                'rtol': 1e-12}).run()
+    assert np.allclose(trajectories[0], res.species, rtol=1e-4)
+
+
+def test_cpu_fallback_failed_nan():
+    if numbalsoda is None:
+        raise SkipTest('numbalsoda not installed')
+    solver = CupSodaSimulator(tyson_model, tspan=np.linspace(0, 500, 101),
+                              integrator_options={'max_steps': 2})
+    tout, trajectories = solver._run_cpu_fallback()
+    assert np.isnan(trajectories).all()
+
+
+@with_model
+def test_cmatrix_and_stoichiometry():
+    Monomer('A', ['b'])
+    Monomer('B', ['b'])
+    Parameter('kf', 2e-3)
+    Parameter('kr', 0.1)
+    Parameter('kdeg', 4e-3)
+    Initial(A(b=None), Parameter('A_0', 100))
+    Initial(B(b=None), Parameter('B_0', 50))
+    Rule('bind', A(b=None) + B(b=None) | A(b=1) % B(b=1), kf, kr)
+    Rule('deg', A(b=None) + A(b=None) >> None, kdeg)
+
+    param_values = [[2e-3, 0.1, 4e-3, 100, 50],
+                    [3e-3, 0.2, 5e-3, 100, 50]]
+    vol = 1e-19
+    solver = CupSodaSimulator(model, tspan=np.linspace(0, 10, 11),
+                              param_values=param_values)
+    solver_vol = CupSodaSimulator(model, tspan=np.linspace(0, 10, 11),
+                                  param_values=param_values,
+                                  integrator_options={'vol': vol})
+
+    a, b, ab = [model.get_species_index(as_complex_pattern(cp)) for cp in
+                (A(b=None), B(b=None), A(b=1) % B(b=1))]
+    # (rate constant, reactant counts, product counts) by (rule, reverse)
+    expected = {
+        ('bind', False): (lambda p: p[0], {a: 1, b: 1}, {ab: 1}),
+        ('bind', True): (lambda p: p[1], {ab: 1}, {a: 1, b: 1}),
+        ('deg', False): (lambda p: 0.5 * p[2], {a: 2}, {}),
+    }
+    assert len(model.reactions) == len(expected)
+
+    cmatrix = solver._get_cmatrix()
+    cmatrix_vol = solver_vol._get_cmatrix()
+    assert cmatrix.shape == (2, 3)
+    for j, rxn in enumerate(model.reactions):
+        rate, left, right = expected[(rxn['rule'][0], rxn['reverse'][0])]
+        order = sum(left.values())
+        for n, p in enumerate(param_values):
+            assert np.isclose(cmatrix[n, j], rate(p))
+            assert np.isclose(cmatrix_vol[n, j],
+                              rate(p) * (N_A * vol) ** (order - 1))
+        for sp in range(len(model.species)):
+            assert solver._left_side[j, sp] == left.get(sp, 0)
+            assert solver._right_side[j, sp] == right.get(sp, 0)
+
+
+@with_model
+def test_create_input_files():
+    Monomer('A')
+    Monomer('B')
+    Parameter('kf', 2e-3)
+    Parameter('kdeg', 0.1)
+    Initial(A(), Parameter('A_0', 100))
+    Rule('dimerize', A() + A() >> B(), kf)
+    Rule('deg', B() >> None, kdeg)
+    Observable('B_total', B())
+
+    solver = CupSodaSimulator(model, tspan=[0, 5, 10],
+                              param_values=[[2e-3, 0.1, 100],
+                                            [4e-3, 0.2, 50]])
+    outdir = tempfile.mkdtemp()
+    try:
+        solver._create_input_files(outdir, np.arange(2),
+                                   solver._get_cmatrix())
+        files = {}
+        for filename in os.listdir(outdir):
+            with open(os.path.join(outdir, filename)) as f:
+                files[filename] = f.read()
+    finally:
+        shutil.rmtree(outdir)
+
+    # Only t_vector ends with a newline
+    assert files == {
+        'atol_vector': '1e-08\n1e-08',
+        'c_matrix': '0.001\t0.1\n0.002\t0.2',
+        'cs_vector': '1',
+        'left_side': '2\t0\n0\t1',
+        'max_steps': '20000',
+        'modelkind': 'deterministic',
+        'MX_0': '100\t0\n50\t0',
+        'right_side': '0\t1\n0\t0',
+        'rtol': '1e-08',
+        't_vector': '0\n5\n10\n',
+        'time_max': '10.0',
+    }
+
+
+@with_model
+def test_load_trajectories():
+    Monomer('A')
+    Monomer('B')
+    Parameter('kf', 2e-3)
+    Parameter('kdeg', 0.1)
+    Initial(A(), Parameter('A_0', 100))
+    Rule('dimerize', A() + A() >> B(), kf)
+    Rule('deg', B() >> None, kdeg)
+    Observable('B_total', B())
+
+    tspan = np.array([0., 5., 10.])
+    # Output files 0 and 1 hold simulations 3 and 1; only species B (index
+    # 1) is output
+    sims = np.array([3, 1])
+    outdir = tempfile.mkdtemp()
+    try:
+        for idx in range(len(sims)):
+            with open(os.path.join(outdir, 'test_load_trajectories_%d' % idx),
+                      'w') as f:
+                f.write('\n'.join('%g\t%g' % (t, (idx + 1) * (t + 1))
+                                  for t in tspan))
+
+        vol = 1e-19
+        for options in ({}, {'vol': vol}):
+            solver = CupSodaSimulator(model, tspan=tspan,
+                                      integrator_options=options)
+            loaders = [solver._load_with_openfile]
+            if pd is not None:
+                loaders.append(solver._load_with_pandas)
+            for loader in loaders:
+                solver._load_output = functools.partial(
+                    loader, dtype=solver._output_dtype)
+                tout = np.full((4, len(tspan)), np.nan, dtype=np.float32)
+                trajectories = np.full((4, len(tspan), 2), np.nan,
+                                       dtype=np.float32)
+                solver._load_trajectories(outdir, sims, tout, trajectories)
+
+                scale = N_A * vol if options else 1
+                assert np.allclose(tout[sims], tspan)
+                assert np.isnan(tout[[0, 2]]).all()
+                assert np.isnan(trajectories[[0, 2]]).all()
+                assert np.isnan(trajectories[:, :, 0]).all()
+                assert np.allclose(trajectories[3, :, 1],
+                                   (tspan + 1) * scale)
+                assert np.allclose(trajectories[1, :, 1],
+                                   2 * (tspan + 1) * scale)
+                assert solver._load_output(
+                    os.path.join(outdir, 'test_load_trajectories_0')
+                ).dtype == np.float32
+
+                # A GPU with no simulations has nothing to load
+                solver._load_trajectories(outdir, sims[:0], tout,
+                                          trajectories)
+    finally:
+        shutil.rmtree(outdir)
@@ -4,6 +4,7 @@ import copy
 import numpy as np
 from pysb import Monomer, Parameter, Initial, Observable, Rule, Expression
 from pysb.simulator import ScipyOdeSimulator
+from pysb.simulator.scipyode import numba, numbalsoda
 from pysb.examples import robertson, earm_1_0
 import unittest
 import pandas as pd
@@ -73,6 +74,16 @@ class TestScipySimulatorSingle(TestScipySimulatorBase):
                                              use_analytic_jacobian=True)
         solver_lsoda_jac.run()
 
+    def test_solve_ivp_solver_run(self):
+        """Test solve_ivp."""
+        solver_ivp = ScipyOdeSimulator(self.model, tspan=self.time,
+                                       integrator='solve_ivp',
+                                       integrator_options={'rtol': 1e-6,
+                                                           'atol': 1e-6})
+        simres = solver_ivp.run()
+        assert np.allclose(simres.species, self.sim.run().species,
+                           rtol=1e-3, atol=1e-3)
+
     def test_y0_as_list(self):
         """Test y0 with list of initial conditions"""
         # Test the initials getter method before anything is changed
@@ -194,6 +205,36 @@ class TestScipyOdeCompilerTests(TestScipySimulatorBase):
         assert simres.species.shape[0] == self.args['tspan'].shape[0]
         assert np.allclose(self.python_res.dataframe, simres.dataframe)
 
+    @unittest.skipIf(numba is None, 'numba not installed')
+    def test_numba(self):
+        sim = ScipyOdeSimulator(compiler='numba', **self.args)
+        simres = sim.run()
+        assert simres.species.shape[0] == self.args['tspan'].shape[0]
+        assert np.allclose(self.python_res.dataframe, simres.dataframe)
+
+    @unittest.skipIf(numba is None or numbalsoda is None,
+                     'numba and numbalsoda not installed')
+    def test_numba_lsoda(self):
+        args = dict(self.args, integrator='lsoda',
+                    use_analytic_jacobian=False)
+        sim = ScipyOdeSimulator(compiler='numba', **args)
+        simres = sim.run()
+        assert simres.species.shape[0] == self.args['tspan'].shape[0]
+        assert np.allclose(self.python_res.dataframe, simres.dataframe)
+
+    @unittest.skipIf(numba is None or numbalsoda is None,
+                     'numba and numbalsoda not installed')
+    def test_numba_lsoda_ensemble(self):
+        args = dict(self.args, integrator='lsoda',
+                    use_analytic_jacobian=False)
+        initials = [[10, 20, 30], [50, 60, 70]]
+        python_res = ScipyOdeSimulator(compiler='python', **args).run(
+            initials=initials)
+        simres = ScipyOdeSimulator(compiler='numba', **args).run(
+            initials=initials)
+        assert simres.nsims == 2
+        assert np.allclose(python_res.species, simres.species)
+
     def test_theano(self):
         sim = ScipyOdeSimulator(compiler='theano', **self.args)
         simres = sim.run()